@@ -47,7 +47,11 @@ class StatementMetrics:
         metrics = set(metrics)
 
         rows = _merge_duplicate_rows(rows, metrics, key)
+        metric_columns = []
         if len(rows) > 0:
+            # All rows in a collection share the same columns, so the available metric columns
+            # only need to be computed once rather than intersected per row.
+            metric_columns = [m for m in metrics if m in rows[0]]
             dropped_metrics = metrics - set(rows[0].keys())
             if dropped_metrics:
                 logger.warning(
@@ -72,8 +76,6 @@ class StatementMetrics:
             if prev is None:
                 continue
 
-            metric_columns = metrics & set(row.keys())
-
             # Take the diff of all metric values between the current row and the previous run's row.
             # There are a couple of edge cases to be aware of:
             #
@@ -85,19 +87,22 @@ class StatementMetrics:
             #    the absence of metrics. On any given check run, most rows will have no difference so this optimization
             #    avoids having to send a lot of unnecessary metrics.
 
-            diffed_row = {k: row[k] - prev[k] if k in metric_columns else row[k] for k in row.keys()}
+            diffs = [row[k] - prev[k] for k in metric_columns]
 
             # Check for negative values, but only in the columns used for metrics
-            if any(diffed_row[k] < 0 for k in metric_columns):
+            if any(diff < 0 for diff in diffs):
                 # A "break" might be expected here instead of "continue," but there are cases where a subset of rows
                 # are removed. To avoid situations where all results are discarded every check run, we err on the side
                 # of potentially including truncated rows that exceed previous run counts.
                 continue
 
             # No changes to the query; no metric needed
-            if all(diffed_row[k] == 0 for k in metric_columns):
+            if all(diff == 0 for diff in diffs):
                 continue
 
+            # The diffed row is only materialized for rows that actually changed
+            diffed_row = dict(row)
+            diffed_row.update(zip(metric_columns, diffs))
             result.append(diffed_row)
 
         self._previous_statements = new_cache
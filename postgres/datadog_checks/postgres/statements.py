@@ -3,12 +3,13 @@
 # Licensed under Simplified BSD License (see LICENSE)
 from __future__ import unicode_literals
 
-import copy
 import time
+from collections import OrderedDict
 
 import psycopg2
 import psycopg2.extras
-from cachetools import TTLCache
+from cachetools import LRUCache
+from six.moves import intern
 
 from datadog_checks.base import is_affirmative
 from datadog_checks.base.utils.common import to_native_string
@@ -42,8 +43,27 @@ SELECT {cols}
 PG_STAT_STATEMENTS_COUNT_QUERY = "SELECT COUNT(*) FROM pg_stat_statements(false)"
 PG_STAT_STATEMENTS_COUNT_QUERY_LT_9_4 = "SELECT COUNT(*) FROM pg_stat_statements"
 
+# Load the column names of the pg_stat_statements view without planning a query over the view
+# itself, which takes a snapshot of the statement stats. Restricted to the schemas on the search
+# path to mirror how the view name resolves in STATEMENTS_QUERY.
+PG_STAT_STATEMENTS_COLUMNS_QUERY = """
+SELECT column_name
+  FROM information_schema.columns
+ WHERE table_name = 'pg_stat_statements'
+   AND table_schema = ANY(current_schemas(false)::text[])
+"""
+
+# Load the total call count per queryid without reading the query text file from disk. A queryid can
+# appear multiple times in the view (once per user and database), and the summed count only stays
+# constant when none of the entries were called.
+QUERYID_TO_CALLS_QUERY = "SELECT queryid, SUM(calls) FROM pg_stat_statements(false) GROUP BY queryid"
+
 DEFAULT_STATEMENTS_LIMIT = 10000
 
+# Number of rows fetched per round trip when streaming pg_stat_statements through a server-side
+# cursor. Keeps peak memory bounded while still amortizing network round trips.
+STATEMENTS_CURSOR_ITER_SIZE = 2000
+
 # Required columns for the check to run
 PG_STAT_STATEMENTS_REQUIRED_COLUMNS = frozenset({'calls', 'query', 'rows'})
 
@@ -116,24 +136,68 @@ class PostgresStatementMetrics(DBMAsyncJob):
         self._config = config
         self._state = StatementMetrics()
         self._stat_column_cache = []
+        # (cols, filters) -> formatted statements SQL; the column list and filter shape are
+        # stable across runs, so the query string only needs to be built when they change
+        self._statements_query_cache = {}
         self._obfuscate_options = to_native_string(json.dumps(self._config.obfuscator_options))
-        # full_statement_text_cache: limit the ingestion rate of full statement text events per query_signature
-        self._full_statement_text_cache = TTLCache(
-            maxsize=config.full_statement_text_cache_max_size,
-            ttl=60 * 60 / config.full_statement_text_samples_per_hour_per_query,
-        )
-
-    def _execute_query(self, cursor, query, params=()):
+        # query_calls_cache: queryid -> total call count from the previous run, used to skip loading
+        # rows whose call counts are unchanged since their derivatives are guaranteed to be zero
+        self._query_calls_cache = {}
+        self._query_calls_tracking = False
+        # tags used to build _tags_no_db, so the filtered list is only rebuilt when they change
+        self._tags_no_db_source = None
+        # obfuscation_cache: raw query text -> (obfuscation result, query signature). Both are
+        # deterministic for a given raw query and pg_stat_statements repeats the same text across
+        # runs, so a cache hit skips a call into the agent's obfuscator and a signature hash
+        self._obfuscation_cache = LRUCache(maxsize=DEFAULT_STATEMENTS_LIMIT)
+        # full_statement_by_signature: query signature -> full obfuscated statement for the rows
+        # normalized during the current run. Metric rows only carry the first 200 characters of
+        # the query text, so FQT events look the full statement up here
+        self._full_statement_by_signature = {}
+        # baseline_metrics: (queryid, datname, rolname) -> normalized row from the most recent run
+        # in which the row was loaded, so that rows skipped by the queryid filter still feed the
+        # derivative computation instead of having their state reset
+        self._baseline_metrics = {}
+        # full_statement_text_cache: limit the ingestion rate of full statement text events per query.
+        # An OrderedDict of row key -> last emission time is cheaper per lookup than a TTLCache, which
+        # maintains expiration bookkeeping on every access; entries are refreshed in place once
+        # expired and the oldest emissions are trimmed when the cache outgrows its bound.
+        self._full_statement_text_cache = OrderedDict()
+        self._full_statement_text_cache_max_size = config.full_statement_text_cache_max_size
+        self._full_statement_text_ttl = 60 * 60 / config.full_statement_text_samples_per_hour_per_query
+
+    def _execute_cursor(self, cursor, query, params=()):
         try:
             self._log.debug("Running query [%s] %s", query, params)
             cursor.execute(query, params)
-            return cursor.fetchall()
+            return cursor
         except (psycopg2.ProgrammingError, psycopg2.errors.QueryCanceled) as e:
             # A failed query could've derived from incorrect columns within the cache. It's a rare edge case,
             # but the next time the query is run, it will retrieve the correct columns.
             self._stat_column_cache = []
             raise e
 
+    def _execute_query(self, cursor, query, params=()):
+        return self._execute_cursor(cursor, query, params).fetchall()
+
+    def _cursor_rows(self, cursor):
+        try:
+            for row in cursor:
+                yield row
+        except psycopg2.Error as e:
+            # a failure in the middle of the stream (e.g. a dropped connection during a fetch)
+            # gets the same user-facing warning and error count as an execute-time failure;
+            # rows already received are still processed
+            if isinstance(e, (psycopg2.ProgrammingError, psycopg2.errors.QueryCanceled)):
+                # as in _execute_cursor, the failure may stem from stale cached columns
+                self._stat_column_cache = []
+            # the per-queryid call counts were already committed for this run, so without a reset the
+            # next run would treat the rows lost here as unchanged and never report their activity
+            self._query_calls_cache = {}
+            self._handle_statements_query_error(e)
+        finally:
+            cursor.close()
+
     def _get_pg_stat_statements_columns(self):
         """
         Load the list of the columns available under the `pg_stat_statements` table. This must be queried because
@@ -143,18 +207,87 @@ class PostgresStatementMetrics(DBMAsyncJob):
         if self._stat_column_cache:
             return self._stat_column_cache
 
-        # Querying over '*' with limit 0 allows fetching only the column names from the cursor without data
+        cursor = self._check._get_db(self._config.dbname).cursor()
+        if self._config.pg_stat_statements_view == 'pg_stat_statements':
+            rows = self._execute_query(cursor, PG_STAT_STATEMENTS_COLUMNS_QUERY)
+            col_names = [row[0] for row in rows]
+            if col_names:
+                # datname and rolname come from the pg_database and pg_roles joins in
+                # STATEMENTS_QUERY rather than from the view, so information_schema does not
+                # report them
+                col_names += ['datname', 'rolname']
+                self._stat_column_cache = col_names
+                return col_names
+            # an empty result means the view is not visible on the search path; fall through to
+            # selecting from the view so the caller gets the error it expects
+
+        # Querying over '*' with limit 0 allows fetching only the column names from the cursor without data.
+        # The view name is used exactly as configured rather than the pg_stat_statements(false) function
+        # form: this path only runs in misconfiguration or custom-view cases, and a missing extension must
+        # raise UndefinedTable for _handle_statements_query_error to record the
+        # pg_stat_statements_not_created warning
         query = STATEMENTS_QUERY.format(
             cols='*', pg_stat_statements_view=self._config.pg_stat_statements_view, limit=0, filters=""
         )
-        cursor = self._check._get_db(self._config.dbname).cursor()
         self._execute_query(cursor, query, params=(self._config.dbname,))
         col_names = [desc[0] for desc in cursor.description] if cursor.description else []
         self._stat_column_cache = col_names
         return col_names
 
+    def _check_called_queries(self, available_columns):
+        """
+        Return the list of queryids whose call counts changed since the previous run, or None when
+        every row must be loaded. Most rows are unchanged between runs and would produce zero-valued
+        derivatives, so skipping them avoids transferring and obfuscating query text that would be
+        discarded anyway.
+        """
+        self._query_calls_tracking = False
+        if not self._check.version or self._check.version < V9_4:
+            return None
+        if self._config.pg_stat_statements_view != 'pg_stat_statements':
+            return None
+        if 'queryid' not in available_columns:
+            # the extension version can lag behind the server version; without the queryid column
+            # (pg_stat_statements < 1.2) the pg_stat_statements(boolean) function used by the
+            # calls query does not exist either
+            return None
+
+        rows = self._execute_query(self._check._get_db(self._config.dbname).cursor(), QUERYID_TO_CALLS_QUERY)
+        self._query_calls_tracking = True
+        prev_query_calls = self._query_calls_cache
+        query_calls = {}
+        called_queryids = []
+        for queryid, calls in rows:
+            if queryid is None:
+                continue
+            query_calls[queryid] = calls
+            if prev_query_calls.get(queryid) != calls:
+                called_queryids.append(queryid)
+        self._query_calls_cache = query_calls
+        if not prev_query_calls:
+            # first run: every row is needed and there is no baseline to filter against
+            return None
+        return called_queryids
+
+    def _apply_called_queries(self, rows):
+        """
+        Merge the rows loaded this run into the baseline kept from previous runs. Rows skipped by
+        the queryid filter diff to zero but must still be passed to the derivative computation,
+        otherwise their state would be reset and the first diff after they become active again
+        would be lost. Rows evicted from pg_stat_statements are dropped from the baseline.
+        """
+        for row in rows:
+            self._baseline_metrics[(row['queryid'], row['datname'], row['rolname'])] = row
+        self._baseline_metrics = {
+            key: row for key, row in self._baseline_metrics.items() if key[0] in self._query_calls_cache
+        }
+        return list(self._baseline_metrics.values())
+
     def run_job(self):
-        self._tags_no_db = [t for t in self._tags if not t.startswith('db:')]
+        # tags rarely change between check runs, so only rebuild the filtered list when they do
+        if self._tags != self._tags_no_db_source:
+            self._tags_no_db_source = self._tags
+            self._tags_no_db = [t for t in self._tags if not t.startswith('db:')]
         self.collect_per_statement_metrics()
 
     def _payload_pg_version(self):
@@ -173,9 +306,6 @@ class PostgresStatementMetrics(DBMAsyncJob):
                 return
             for event in self._rows_to_fqt_events(rows):
                 self._check.database_monitoring_query_sample(json.dumps(event, default=default_json_event_encoding))
-            # truncate query text to the maximum length supported by metrics tags
-            for row in rows:
-                row['query'] = row['query'][0:200]
             payload = {
                 'host': self._check.resolved_hostname,
                 'timestamp': time.time() * 1000,
@@ -192,6 +322,7 @@ class PostgresStatementMetrics(DBMAsyncJob):
             return []
 
     def _load_pg_stat_statements(self):
+        self._query_calls_tracking = False
         try:
             available_columns = set(self._get_pg_stat_statements_columns())
             missing_columns = PG_STAT_STATEMENTS_REQUIRED_COLUMNS - available_columns
@@ -222,73 +353,98 @@ class PostgresStatementMetrics(DBMAsyncJob):
             if self._config.dbstrict:
                 filters = "AND pg_database.datname = %s"
                 params = (self._config.dbname,)
-            return self._execute_query(
-                self._check._get_db(self._config.dbname).cursor(cursor_factory=psycopg2.extras.DictCursor),
-                STATEMENTS_QUERY.format(
-                    cols=', '.join(query_columns),
+            called_queryids = self._check_called_queries(available_columns)
+            if called_queryids is not None:
+                if not called_queryids:
+                    # nothing was called since the last run; the baseline rows kept by
+                    # _apply_called_queries cover every live row
+                    return []
+                filters += " AND queryid = ANY(%s)"
+                params += (called_queryids,)
+            # a server-side cursor streams rows in batches instead of materializing the full
+            # result set in memory; the connection is in autocommit mode so the cursor must be
+            # declared WITH HOLD
+            cursor = self._check._get_db(self._config.dbname).cursor(
+                name='datadog_pg_stat_statements',
+                cursor_factory=psycopg2.extras.DictCursor,
+                withhold=True,
+            )
+            cursor.itersize = STATEMENTS_CURSOR_ITER_SIZE
+            cols = ', '.join(query_columns)
+            query = self._statements_query_cache.get((cols, filters))
+            if query is None:
+                query = STATEMENTS_QUERY.format(
+                    cols=cols,
                     pg_stat_statements_view=self._config.pg_stat_statements_view,
                     filters=filters,
                     limit=DEFAULT_STATEMENTS_LIMIT,
-                ),
-                params=params,
-            )
-        except psycopg2.Error as e:
-            error_tag = "error:database-{}".format(type(e).__name__)
-
-            if (
-                isinstance(e, psycopg2.errors.ObjectNotInPrerequisiteState)
-            ) and 'pg_stat_statements must be loaded' in str(e.pgerror):
-                error_tag = "error:database-{}-pg_stat_statements_not_loaded".format(type(e).__name__)
-                self._check.record_warning(
-                    DatabaseConfigurationError.pg_stat_statements_not_loaded,
-                    warning_with_tags(
-                        "Unable to collect statement metrics because pg_stat_statements "
-                        "extension is not loaded in database '%s'. "
-                        "See https://docs.datadoghq.com/database_monitoring/setup_postgres/"
-                        "troubleshooting#%s for more details",
-                        self._config.dbname,
-                        DatabaseConfigurationError.pg_stat_statements_not_loaded.value,
-                        host=self._check.resolved_hostname,
-                        dbname=self._config.dbname,
-                        code=DatabaseConfigurationError.pg_stat_statements_not_loaded.value,
-                    ),
-                )
-            elif isinstance(e, psycopg2.errors.UndefinedTable) and 'pg_stat_statements' in str(e.pgerror):
-                error_tag = "error:database-{}-pg_stat_statements_not_created".format(type(e).__name__)
-                self._check.record_warning(
-                    DatabaseConfigurationError.pg_stat_statements_not_created,
-                    warning_with_tags(
-                        "Unable to collect statement metrics because pg_stat_statements is not created "
-                        "in database '%s'. See https://docs.datadoghq.com/database_monitoring/setup_postgres/"
-                        "troubleshooting#%s for more details",
-                        self._config.dbname,
-                        DatabaseConfigurationError.pg_stat_statements_not_created.value,
-                        host=self._check.resolved_hostname,
-                        dbname=self._config.dbname,
-                        code=DatabaseConfigurationError.pg_stat_statements_not_created.value,
-                    ),
-                )
-            else:
-                self._check.warning(
-                    warning_with_tags(
-                        "Unable to collect statement metrics because of an error running queries "
-                        "in database '%s'. See https://docs.datadoghq.com/database_monitoring/troubleshooting for "
-                        "help: %s",
-                        self._config.dbname,
-                        str(e),
-                        host=self._check.resolved_hostname,
-                        dbname=self._config.dbname,
-                    ),
                 )
+                self._statements_query_cache[(cols, filters)] = query
+            self._execute_cursor(cursor, query, params=params)
+            return self._cursor_rows(cursor)
+        except psycopg2.Error as e:
+            # drop the per-queryid call counts committed earlier in this run so the next run does a
+            # full load; otherwise the rows behind this failed load would be treated as unchanged
+            # and their last interval of activity would never be reported
+            self._query_calls_cache = {}
+            self._handle_statements_query_error(e)
+            return []
 
-            self._check.count(
-                "dd.postgres.statement_metrics.error",
-                1,
-                tags=self._tags + [error_tag] + self._check._get_debug_tags(),
-                hostname=self._check.resolved_hostname,
+    def _handle_statements_query_error(self, e):
+        error_tag = "error:database-{}".format(type(e).__name__)
+
+        if isinstance(e, psycopg2.errors.ObjectNotInPrerequisiteState) and 'pg_stat_statements must be loaded' in str(
+            e.pgerror
+        ):
+            error_tag = "error:database-{}-pg_stat_statements_not_loaded".format(type(e).__name__)
+            self._check.record_warning(
+                DatabaseConfigurationError.pg_stat_statements_not_loaded,
+                warning_with_tags(
+                    "Unable to collect statement metrics because pg_stat_statements "
+                    "extension is not loaded in database '%s'. "
+                    "See https://docs.datadoghq.com/database_monitoring/setup_postgres/"
+                    "troubleshooting#%s for more details",
+                    self._config.dbname,
+                    DatabaseConfigurationError.pg_stat_statements_not_loaded.value,
+                    host=self._check.resolved_hostname,
+                    dbname=self._config.dbname,
+                    code=DatabaseConfigurationError.pg_stat_statements_not_loaded.value,
+                ),
+            )
+        elif isinstance(e, psycopg2.errors.UndefinedTable) and 'pg_stat_statements' in str(e.pgerror):
+            error_tag = "error:database-{}-pg_stat_statements_not_created".format(type(e).__name__)
+            self._check.record_warning(
+                DatabaseConfigurationError.pg_stat_statements_not_created,
+                warning_with_tags(
+                    "Unable to collect statement metrics because pg_stat_statements is not created "
+                    "in database '%s'. See https://docs.datadoghq.com/database_monitoring/setup_postgres/"
+                    "troubleshooting#%s for more details",
+                    self._config.dbname,
+                    DatabaseConfigurationError.pg_stat_statements_not_created.value,
+                    host=self._check.resolved_hostname,
+                    dbname=self._config.dbname,
+                    code=DatabaseConfigurationError.pg_stat_statements_not_created.value,
+                ),
+            )
+        else:
+            self._check.warning(
+                warning_with_tags(
+                    "Unable to collect statement metrics because of an error running queries "
+                    "in database '%s'. See https://docs.datadoghq.com/database_monitoring/troubleshooting for "
+                    "help: %s",
+                    self._config.dbname,
+                    str(e),
+                    host=self._check.resolved_hostname,
+                    dbname=self._config.dbname,
+                ),
             )
 
-            return []
+        self._check.count(
+            "dd.postgres.statement_metrics.error",
+            1,
+            tags=self._tags + [error_tag] + self._check._get_debug_tags(),
+            hostname=self._check.resolved_hostname,
+        )
 
     def _emit_pg_stat_statements_metrics(self):
         query = PG_STAT_STATEMENTS_COUNT_QUERY_LT_9_4 if self._check.version < V9_4 else PG_STAT_STATEMENTS_COUNT_QUERY
@@ -316,13 +472,17 @@ class PostgresStatementMetrics(DBMAsyncJob):
             self._log.warning("Failed to query for pg_stat_statements count: %s", e)
 
     def _collect_metrics_rows(self):
-        rows = self._load_pg_stat_statements()
-        if rows:
-            self._emit_pg_stat_statements_metrics()
-
-        rows = self._normalize_queries(rows)
+        self._full_statement_by_signature = {}
+        # rows are streamed from the server-side cursor straight into normalization so that
+        # obfuscation is pipelined with the network receive
+        rows = self._normalize_queries(self._load_pg_stat_statements())
+        if self._query_calls_tracking:
+            rows = self._apply_called_queries(rows)
+        else:
+            rows = list(rows)
         if not rows:
             return []
+        self._emit_pg_stat_statements_metrics()
 
         available_columns = set(rows[0].keys())
         metric_columns = available_columns & PG_STAT_STATEMENTS_METRICS_COLUMNS
@@ -336,54 +496,86 @@ class PostgresStatementMetrics(DBMAsyncJob):
         return rows
 
     def _normalize_queries(self, rows):
-        normalized_rows = []
         for row in rows:
-            normalized_row = dict(copy.copy(row))
-            try:
-                statement = obfuscate_sql_with_metadata(row['query'], self._obfuscate_options)
-            except Exception as e:
-                # obfuscation errors are relatively common so only log them during debugging
-                self._log.debug("Failed to obfuscate query '%s': %s", row['query'], e)
-                continue
-
-            obfuscated_query = statement['query']
-            normalized_row['query'] = obfuscated_query
-            normalized_row['query_signature'] = compute_sql_signature(obfuscated_query)
+            # DictRow is already dict-like, so a single copy is enough
+            normalized_row = dict(row)
+            query = row['query']
+            cached = self._obfuscation_cache.get(query)
+            if cached is None:
+                try:
+                    statement = obfuscate_sql_with_metadata(query, self._obfuscate_options)
+                except Exception as e:
+                    # obfuscation errors are relatively common so only log them during debugging
+                    self._log.debug("Failed to obfuscate query '%s': %s", query, e)
+                    continue
+                query_signature = compute_sql_signature(statement['query'])
+                # compute_sql_signature returns None when the obfuscated statement is empty; such
+                # rows are kept with a None signature, but only strings can be interned
+                cached = (statement, intern(query_signature) if query_signature is not None else None)
+                self._obfuscation_cache[query] = cached
+            statement, query_signature = cached
+
+            # the row key tuple is hashed and compared repeatedly by the FQT cache and the
+            # derivative state across runs; interning its components makes those lookups compare
+            # already-seen string objects by identity
+            for column in ('datname', 'rolname'):
+                value = normalized_row.get(column)
+                if value is not None:
+                    normalized_row[column] = intern(value)
+
+            # truncate query text to the maximum length supported by metrics tags, keeping the
+            # full statement aside for FQT events
+            self._full_statement_by_signature[query_signature] = statement['query']
+            normalized_row['query'] = statement['query'][0:200]
+            normalized_row['query_signature'] = query_signature
             metadata = statement['metadata']
             normalized_row['dd_tables'] = metadata.get('tables', None)
             normalized_row['dd_commands'] = metadata.get('commands', None)
-            normalized_rows.append(normalized_row)
-
-        return normalized_rows
+            yield normalized_row
 
     def _rows_to_fqt_events(self, rows):
+        now = time.time()
+        cache = self._full_statement_text_cache
+        ttl = self._full_statement_text_ttl
+        max_size = self._full_statement_text_cache_max_size
+        # the event shape is fixed, so build the batch-constant fields once and only fill in the
+        # row-specific ones per event
+        event_template = {
+            "timestamp": now * 1000,
+            "host": self._check.resolved_hostname,
+            "ddagentversion": datadog_agent.get_version(),
+            "ddsource": "postgres",
+            "dbm_type": "fqt",
+        }
         for row in rows:
             query_cache_key = _row_key(row)
-            if query_cache_key in self._full_statement_text_cache:
-                continue
-            self._full_statement_text_cache[query_cache_key] = True
+            last_emitted = cache.get(query_cache_key)
+            if last_emitted is not None:
+                if now - last_emitted < ttl:
+                    continue
+                # delete before re-inserting so the cache's insertion order tracks emission time
+                del cache[query_cache_key]
+            cache[query_cache_key] = now
+            while len(cache) > max_size:
+                # evict the oldest emissions; they are the closest to expiring anyway
+                cache.popitem(last=False)
             row_tags = self._tags_no_db + [
                 "db:{}".format(row['datname']),
                 "rolname:{}".format(row['rolname']),
             ]
-            yield {
-                "timestamp": time.time() * 1000,
-                "host": self._check.resolved_hostname,
-                "ddagentversion": datadog_agent.get_version(),
-                "ddsource": "postgres",
-                "ddtags": ",".join(row_tags),
-                "dbm_type": "fqt",
-                "db": {
-                    "instance": row['datname'],
-                    "query_signature": row['query_signature'],
-                    "statement": row['query'],
-                    "metadata": {
-                        "tables": row['dd_tables'],
-                        "commands": row['dd_commands'],
-                    },
-                },
-                "postgres": {
-                    "datname": row["datname"],
-                    "rolname": row["rolname"],
+            event = event_template.copy()
+            event["ddtags"] = ",".join(row_tags)
+            event["db"] = {
+                "instance": row['datname'],
+                "query_signature": row['query_signature'],
+                "statement": self._full_statement_by_signature.get(row['query_signature'], row['query']),
+                "metadata": {
+                    "tables": row['dd_tables'],
+                    "commands": row['dd_commands'],
                 },
             }
+            event["postgres"] = {
+                "datname": row["datname"],
+                "rolname": row["rolname"],
+            }
+            yield event
@@ -242,6 +242,158 @@ def test_statement_metrics_with_duplicates(aggregator, integration_check, dbm_in
     assert row['calls'] == 2
 
 
+def test_statement_metrics_skip_unchanged_rows(aggregator, integration_check, dbm_instance):
+    # don't need samples for this test
+    dbm_instance['query_samples'] = {'enabled': False}
+    # very low collection interval for test purposes
+    dbm_instance['query_metrics'] = {'enabled': True, 'run_sync': True, 'collection_interval': 0.1}
+
+    query = "SELECT city FROM persons WHERE city = %s"
+    obfuscated_param = '?' if POSTGRES_VERSION.split('.')[0] == "9" else '$1'
+    query_signature = compute_sql_signature(query % obfuscated_param)
+
+    check = integration_check(dbm_instance)
+    check._connect()
+    cursor = check.db.cursor()
+
+    # first run bootstraps the derivative state and the per-queryid call counts
+    cursor.execute(query, ("hello",))
+    check.check(dbm_instance)
+    if not check.statement_metrics._query_calls_tracking:
+        pytest.skip("per-queryid call tracking is not supported on this pg_stat_statements setup")
+
+    # second run: the query was called again so its diff is collected
+    cursor.execute(query, ("hello",))
+    check.check(dbm_instance)
+    events = aggregator.get_event_platform_events("dbm-metrics")
+    assert len(events) == 1
+    matching = [r for r in events[0]['postgres_rows'] if r['query_signature'] == query_signature]
+    assert len(matching) == 1
+    assert matching[0]['calls'] == 1
+
+    # third run: the query is idle so it is skipped by the queryid filter and produces no metrics,
+    # but its last loaded values must be preserved in the baseline
+    aggregator.reset()
+    check.check(dbm_instance)
+    for event in aggregator.get_event_platform_events("dbm-metrics"):
+        assert [r for r in event['postgres_rows'] if r['query_signature'] == query_signature] == []
+    baseline_rows = [
+        r for r in check.statement_metrics._baseline_metrics.values() if r['query_signature'] == query_signature
+    ]
+    assert len(baseline_rows) == 1
+
+    # fourth run: the query becomes active again and its diff is computed against the values
+    # last loaded two runs ago rather than being treated as a newly seen row
+    aggregator.reset()
+    cursor.execute(query, ("hello",))
+    check.check(dbm_instance)
+    events = aggregator.get_event_platform_events("dbm-metrics")
+    assert len(events) == 1
+    matching = [r for r in events[0]['postgres_rows'] if r['query_signature'] == query_signature]
+    assert len(matching) == 1
+    assert matching[0]['calls'] == 1
+
+
+def test_statement_metrics_no_called_queries(integration_check, dbm_instance):
+    # don't need samples for this test
+    dbm_instance['query_samples'] = {'enabled': False}
+    dbm_instance['query_metrics'] = {'enabled': True, 'run_sync': True, 'collection_interval': 0.1}
+
+    check = integration_check(dbm_instance)
+    check._connect()
+    # run check so all internal state is correctly initialized
+    check.check(dbm_instance)
+
+    # when nothing was called since the previous run there is nothing to load; the baseline kept
+    # by _apply_called_queries covers every live row
+    with mock.patch.object(check.statement_metrics, '_check_called_queries', return_value=[]):
+        assert check.statement_metrics._load_pg_stat_statements() == []
+
+
+def test_statement_metrics_baseline_pruned_on_eviction(aggregator, integration_check, dbm_instance):
+    # don't need samples for this test
+    dbm_instance['query_samples'] = {'enabled': False}
+    dbm_instance['query_metrics'] = {'enabled': True, 'run_sync': True, 'collection_interval': 0.1}
+
+    query = "SELECT city FROM persons WHERE city = %s"
+    obfuscated_param = '?' if POSTGRES_VERSION.split('.')[0] == "9" else '$1'
+    query_signature = compute_sql_signature(query % obfuscated_param)
+
+    check = integration_check(dbm_instance)
+    check._connect()
+    cursor = check.db.cursor()
+
+    cursor.execute(query, ("hello",))
+    check.check(dbm_instance)
+    if not check.statement_metrics._query_calls_tracking:
+        pytest.skip("per-queryid call tracking is not supported on this pg_stat_statements setup")
+    cursor.execute(query, ("hello",))
+    check.check(dbm_instance)
+
+    statement_metrics = check.statement_metrics
+    matching_keys = [
+        key for key, row in statement_metrics._baseline_metrics.items() if row['query_signature'] == query_signature
+    ]
+    assert len(matching_keys) == 1
+
+    # simulate the row being evicted from pg_stat_statements: once its queryid no longer shows up
+    # in the per-queryid call counts, the baseline entry is dropped on the next merge
+    del statement_metrics._query_calls_cache[matching_keys[0][0]]
+    statement_metrics._apply_called_queries([])
+    assert [
+        row for row in statement_metrics._baseline_metrics.values() if row['query_signature'] == query_signature
+    ] == []
+
+
+def _fqt_row(query):
+    return {
+        'query': query[0:200],
+        'query_signature': compute_sql_signature(query),
+        'datname': 'datadog_test',
+        'rolname': 'bob',
+        'dd_tables': ['persons'],
+        'dd_commands': ['SELECT'],
+    }
+
+
+def test_full_statement_text_cache_ttl(integration_check, dbm_instance):
+    # samples_per_hour_per_query is 1 by default, so within this test a second emission for the
+    # same query only happens after its cached entry is aged past the TTL
+    check = integration_check(dbm_instance)
+    statement_metrics = check.statement_metrics
+    statement_metrics._tags_no_db = []
+
+    row = _fqt_row("SELECT city FROM persons WHERE city = 'hello'")
+    cache_key = (row['query_signature'], row['datname'], row['rolname'])
+
+    assert len(list(statement_metrics._rows_to_fqt_events([row]))) == 1
+    # within the TTL the same query is rate limited
+    assert len(list(statement_metrics._rows_to_fqt_events([row]))) == 0
+    # once the cached emission expires the query is emitted and tracked again
+    statement_metrics._full_statement_text_cache[cache_key] -= statement_metrics._full_statement_text_ttl + 1
+    assert len(list(statement_metrics._rows_to_fqt_events([row]))) == 1
+    assert len(list(statement_metrics._rows_to_fqt_events([row]))) == 0
+
+
+def test_full_statement_text_cache_max_size(integration_check, dbm_instance):
+    dbm_instance['full_statement_text_cache_max_size'] = 2
+    check = integration_check(dbm_instance)
+    statement_metrics = check.statement_metrics
+    statement_metrics._tags_no_db = []
+
+    row1 = _fqt_row("SELECT city FROM persons WHERE city = 'one'")
+    row2 = _fqt_row("SELECT city FROM persons WHERE city = 'two'")
+    row3 = _fqt_row("SELECT city FROM persons WHERE city = 'three'")
+
+    assert len(list(statement_metrics._rows_to_fqt_events([row1]))) == 1
+    # emitting two more queries trims the oldest emission to keep the cache within its bound
+    assert len(list(statement_metrics._rows_to_fqt_events([row2, row3]))) == 2
+    assert len(statement_metrics._full_statement_text_cache) == 2
+    # row1 was trimmed so it is no longer rate limited, while row3 still is
+    assert len(list(statement_metrics._rows_to_fqt_events([row1]))) == 1
+    assert len(list(statement_metrics._rows_to_fqt_events([row3]))) == 0
+
+
 @pytest.fixture
 def bob_conn():
     conn = psycopg2.connect(host=HOST, dbname=DB_NAME, user="bob", password="bob")
@@ -1398,3 +1550,29 @@ def test_statement_metrics_database_errors(
     )
 
     assert check.warnings == expected_warnings
+
+
+def test_statement_metrics_pg_stat_statements_not_created(aggregator, integration_check, dbm_instance):
+    # the pg_stat_statements extension is only created in the datadog_test database, so running against
+    # another database exercises the real column discovery path for the not-created error rather than
+    # injecting the exception via a mock
+    dbm_instance['dbname'] = 'dogs'
+    # don't need samples for this test
+    dbm_instance['query_samples'] = {'enabled': False}
+    dbm_instance['query_metrics'] = {'enabled': True, 'run_sync': True, 'collection_interval': 0.1}
+    check = integration_check(dbm_instance)
+    check._connect()
+    check.check(dbm_instance)
+
+    expected_tags = dbm_instance['tags'] + [
+        'db:dogs',
+        'port:{}'.format(PORT),
+        'agent_hostname:stubbed.hostname',
+        'error:database-UndefinedTable-pg_stat_statements_not_created',
+    ]
+
+    aggregator.assert_metric(
+        'dd.postgres.statement_metrics.error', value=1.0, count=1, tags=expected_tags, hostname='stubbed.hostname'
+    )
+
+    assert any('code=pg-stat-statements-not-created dbname=dogs' in warning for warning in check.warnings)